@@ -1,32 +1,458 @@
 from pygls.server import LanguageServer
-from lsprotocol.types import ExecuteCommandParams
+from lsprotocol.types import (
+    INITIALIZE,
+    SHUTDOWN,
+    InitializeParams,
+    WorkDoneProgressBegin,
+    WorkDoneProgressEnd,
+    WorkDoneProgressReport,
+)
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from operator import itemgetter
+from typing import Optional
 import os
 import ast
+import hashlib
+import itertools
+import multiprocessing
+import re
+import struct
+import sys
+import threading
+import uuid
 
 # Provide name and version for the server
 ls = LanguageServer(name="function-analyzer", version="1.0.0")
 
+# FA_VERBOSE=1 turns on diagnostic output on stderr.
+LOG_VERBOSE = os.environ.get('FA_VERBOSE') == '1'
+
+# Settings sent by the client in initializationOptions.globalSettings.
+GLOBAL_SETTINGS = {}
+
+# Per-folder settings from initializationOptions.settings, each with its `cwd`.
+WORKSPACE_SETTINGS = []
+
+
+def _user_cache_dir():
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~\\AppData\\Local')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'function-analyzer')
+
+
+# Per-user on-disk counts; initializationOptions.storagePath overrides it.
+CACHE_DIR = _user_cache_dir()
+
+# Entries kept on disk; past this the oldest are dropped once per session.
+_DISK_CACHE_MAX = 100_000
+_DISK_CACHE_TRIMMED = False
+
+# Directories never descended into, besides hidden ones; see `excludePaths`.
+_PRUNE = frozenset({
+    '__pycache__', 'venv', 'env', 'node_modules', 'site-packages',
+    'build', 'dist',
+})
+
+# LRU of function counts keyed by (abs_path, st_mtime_ns, st_size).
+_CACHE_MAX = 4096
+_PARSE_CACHE: OrderedDict[tuple[str, int, int], int] = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+# The most recent scan only: (folder_path, {path: (st_mtime_ns, st_size, count)}).
+_LAST_SNAPSHOT: tuple[Optional[str], dict[str, tuple[int, int, int]]] = (None, {})
+
+# Below this many files to parse, count them in this process instead.
+_IN_PROCESS_MAX = 32
+
+# A file with no match has no top-level functions.
+_DEF_RE = re.compile(rb'^(?:\xef\xbb\xbf)?(?:async\s+)?def\s', re.MULTILINE)
+
+# Part of every disk cache key: the Python version whose parser gave the count.
+_COUNTER_TAG = bytes(sys.version_info[:2])
+
+# One disk cache entry: counter tag, st_mtime_ns, st_size, count. Plain data,
+# never pickle, so a planted entry can at worst give a wrong count.
+_ENTRY = struct.Struct('<2sqqq')
+
+_FDef = ast.FunctionDef
+_AFDef = ast.AsyncFunctionDef
+_ONLY_AST = ast.PyCF_ONLY_AST
+
+# Stale files are handed to the workers in batches of this many, sorted by inode.
+_READ_BATCH = 64
+
+# Worker pool shared by all scans, created on first use with half the cores.
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# Files per progress report and per partial result batch.
+_PARTIAL_BATCH = 500
+
+
+def _iter_py_files(root, prune=_PRUNE):
+    # Yields (path, stat) for every .py file below root, skipping pruned dirs.
+    scandir = os.scandir
+    stack = [root]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        try:
+            it = scandir(pop())
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                name = e.name
+                if e.is_dir(follow_symlinks=False):
+                    if name[0] != '.' and name not in prune:
+                        push(e.path)
+                elif name.endswith('.py') and e.is_file(follow_symlinks=False):
+                    try:
+                        yield e.path, e.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+
+
+def _count_top_level_defs(source: bytes) -> int:
+    # Counts module-level def/async def; raises SyntaxError on invalid source.
+    tree = compile(source, '<unknown>', 'exec', _ONLY_AST, dont_inherit=True)
+    fdef, afdef = _FDef, _AFDef
+    count = 0
+    for node in tree.body:
+        # Node classes are never subclassed, so identity beats isinstance().
+        t = type(node)
+        if t is fdef or t is afdef:
+            count += 1
+    return count
+
+
+def _read_bytes(path, size):
+    # compile() wants bytes anyway, so read them in one call of known size.
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        return os.read(fd, size)
+    finally:
+        os.close(fd)
+
+
+def _count_source(source):
+    if not _DEF_RE.search(source):
+        return 0
+    return _count_top_level_defs(source)
+
+
+def _disk_cache_load(entry, mtime_ns, size):
+    try:
+        with open(entry, 'rb') as f:
+            data = f.read(_ENTRY.size + 1)
+    except OSError:
+        return None
+    # Missing, truncated or from another Python version: treat as a miss.
+    if len(data) != _ENTRY.size:
+        return None
+    tag, saved_mtime_ns, saved_size, count = _ENTRY.unpack(data)
+    if tag != _COUNTER_TAG or saved_mtime_ns != mtime_ns or saved_size != size or count < 0:
+        return None
+    return count
+
+
+def _disk_cache_store(entry, mtime_ns, size, count):
+    # Best effort; the rename means no reader ever sees a half-written entry.
+    tmp = f'{entry}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(_ENTRY.pack(_COUNTER_TAG, mtime_ns, size, count))
+        os.replace(tmp, entry)
+    except OSError:
+        pass
+
+
+def _cache_entry(cache_dir, digest):
+    # Fanned out over two-character subdirectories to keep each one small.
+    return os.path.join(cache_dir, digest[:2], digest[2:])
+
+
+def _path_entry(cache_dir, path):
+    return _cache_entry(cache_dir, hashlib.sha1(os.fsencode(path)).hexdigest())
+
+
+def _trim_disk_cache(cache_dir, limit=_DISK_CACHE_MAX):
+    entries = []
+    try:
+        for sub in os.scandir(cache_dir):
+            if sub.is_dir(follow_symlinks=False):
+                for e in os.scandir(sub.path):
+                    entries.append((e.stat(follow_symlinks=False).st_mtime_ns, e.path))
+    except OSError:
+        return
+    if len(entries) <= limit:
+        return
+    # Least recently written first, down to three quarters of the limit.
+    entries.sort()
+    for _, path in entries[:len(entries) - limit * 3 // 4]:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _count_by_content(source, cache_dir):
+    # Keyed by SHA-256, so this survives mtime-only changes like a checkout.
+    digest = hashlib.sha256(source).hexdigest()
+    entry = _cache_entry(cache_dir, digest)
+    # Content entries have no mtime; the length is a cheap sanity check.
+    count = _disk_cache_load(entry, 0, len(source))
+    if count is None:
+        count = _count_source(source)
+        _disk_cache_store(entry, 0, len(source), count)
+    return count
+
+
+def _count_file(item, cache_dir=None):
+    # Top-level so it can be pickled into the worker processes.
+    # The caller already checked the per-path entry; this refreshes it.
+    path, size, mtime_ns = item
+    try:
+        source = _read_bytes(path, size)
+        if cache_dir is None:
+            count = _count_source(source)
+        else:
+            count = _count_by_content(source, cache_dir)
+    except Exception as e:
+        return path, f'Error: {str(e)}'
+    if cache_dir is not None:
+        _disk_cache_store(_path_entry(cache_dir, path), mtime_ns, size, count)
+    return path, count
+
+
+def _get_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            workers = max(2, (os.cpu_count() or 2) // 2)
+            # Never fork: pygls' reader thread sits in stdin.readline()
+            # holding the buffer lock, and a forked child deadlocks when
+            # multiprocessing closes its copy of stdin.
+            ctx = multiprocessing.get_context('spawn')
+            _POOL = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+        return _POOL
+
+
+def _discard_pool(pool):
+    # A worker died (OOM kill, crash); the next _get_pool() starts afresh.
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is pool:
+            _POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _cache_get(key):
+    with _CACHE_LOCK:
+        count = _PARSE_CACHE.get(key)
+        if count is not None:
+            _PARSE_CACHE.move_to_end(key)
+        return count
+
+
+def _cache_put(key, count):
+    with _CACHE_LOCK:
+        _PARSE_CACHE[key] = count
+        _PARSE_CACHE.move_to_end(key)
+        if len(_PARSE_CACHE) > _CACHE_MAX:
+            _PARSE_CACHE.popitem(last=False)
+
+
+@ls.feature(INITIALIZE)
+def initialize(params: InitializeParams):
+    global CACHE_DIR
+    options = params.initialization_options or {}
+    if options.get('storagePath'):
+        CACHE_DIR = os.path.join(options['storagePath'], 'counts')
+    GLOBAL_SETTINGS.update(options.get('globalSettings', {}))
+    WORKSPACE_SETTINGS[:] = options.get('settings') or []
+
+
+def _settings_for(folder_path):
+    # Settings of the innermost workspace folder holding folder_path.
+    target = os.path.normcase(folder_path)
+    best, best_len = GLOBAL_SETTINGS, -1
+    for settings in WORKSPACE_SETTINGS:
+        if not settings.get('cwd'):
+            continue
+        root = os.path.normcase(os.path.abspath(settings['cwd']))
+        inside = target == root or target.startswith(root.rstrip(os.sep) + os.sep)
+        if inside and len(root) > best_len:
+            best, best_len = settings, len(root)
+    return best
+
+
+@ls.feature(SHUTDOWN)
+def shutdown(*args):
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait=False, cancel_futures=True)
+
+
 @ls.command('functionAnalyzer.countFunctions')
-def count_functions(ls: LanguageServer, params: ExecuteCommandParams):
-    folder_path = params.arguments[0] if params.arguments else None
+@ls.thread()
+def count_functions(ls: LanguageServer, args: list):
+    global _LAST_SNAPSHOT, _DISK_CACHE_TRIMMED
+    # pygls hands command handlers the `arguments` list, not the params.
+    folder_path = args[0] if args else None
     if not folder_path:
         ls.show_message('No folder path provided.', msg_type=1)
         return {}
+    # Normalize once here; every path the walk yields is then already absolute.
+    folder_path = os.path.abspath(folder_path)
+
+    # An optional {"partialResultToken": ...} streams the counts as partial
+    # results; an optional {"excludePaths": [...]} overrides the settings.
+    options = args[1] if len(args) > 1 and isinstance(args[1], dict) else {}
+    partial_token = options.get('partialResultToken')
+
+    # If the client supports work done progress it sees a running file count.
+    token = None
+    window = ls.client_capabilities.window
+    if window is not None and window.work_done_progress:
+        token = str(uuid.uuid4())
+        ls.progress.create(token)
+        ls.progress.begin(token, WorkDoneProgressBegin(title='Counting Python functions'))
+    summary_only = partial_token is not None
 
+    exclude = options.get('excludePaths')
+    if exclude is None:
+        exclude = _settings_for(folder_path).get('excludePaths', ())
+    prune = _PRUNE.union(exclude)
+    cache_dir = CACHE_DIR
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        cache_dir = None
+    last_folder, previous = _LAST_SNAPSHOT
+    if last_folder != folder_path:
+        previous = {}
+    snapshot = {}
     result = {}
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            if file.endswith('.py'):
-                path = os.path.join(root, file)
+    misses = {}
+    batch = {}
+    done = 0
+
+    def _emit(path, count):
+        # With a partial result token only the current batch is held.
+        nonlocal done
+        done += 1
+        if summary_only:
+            batch[path] = count
+        else:
+            result[path] = count
+        if done % _PARTIAL_BATCH == 0:
+            _report()
+
+    def _report():
+        if partial_token is not None:
+            ls.progress.report(partial_token, dict(batch))
+        if token is not None:
+            ls.progress.report(token, WorkDoneProgressReport(message=f'{done} files'))
+        batch.clear()
+
+    def _by_inode(ready):
+        # Stable on the inode alone, so a zero st_ino keeps the walk order.
+        ready.sort(key=itemgetter(0))
+        for _, path, size, mtime_ns in ready:
+            yield path, size, mtime_ns
+        ready.clear()
+
+    def _pending():
+        # Settle unchanged files here; yield the rest while the walk goes on.
+        ready = []
+        for path, st in _iter_py_files(folder_path, prune):
+            entry = previous.get(path)
+            if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                snapshot[path] = entry
+                _emit(path, entry[2])
+                continue
+            key = (path, st.st_mtime_ns, st.st_size)
+            count = _cache_get(key)
+            if count is None and cache_dir is not None:
+                # Stat-keyed disk entries are checked here, so a restarted
+                # server with a warm cache starts no workers at all.
+                count = _disk_cache_load(_path_entry(cache_dir, path), st.st_mtime_ns, st.st_size)
+                if count is not None:
+                    _cache_put(key, count)
+            if count is None:
+                if not summary_only:
+                    # Pre-fill the slot so results keep the walk order.
+                    result[path] = None
+                misses[path] = key
+                ready.append((st.st_ino, path, st.st_size, st.st_mtime_ns))
+                if len(ready) >= _READ_BATCH:
+                    yield from _by_inode(ready)
+            else:
+                snapshot[path] = (st.st_mtime_ns, st.st_size, count)
+                _emit(path, count)
+        yield from _by_inode(ready)
+
+    def _collect(counts):
+        # `misses` keeps only the files still waiting for a count.
+        for path, count in counts:
+            _emit(path, count)
+            key = misses.pop(path)
+            if isinstance(count, int):
+                _cache_put(key, count)
+                snapshot[path] = (key[1], key[2], count)
+
+    count_file = partial(_count_file, cache_dir=cache_dir)
+
+    try:
+        pending = _pending()
+        head = list(itertools.islice(pending, _IN_PROCESS_MAX))
+        if len(head) < _IN_PROCESS_MAX:
+            # Too few stale files to pay for starting and feeding worker processes.
+            _collect(map(count_file, head))
+        else:
+            # Counting is CPU-bound, so spread it over the cores. If the pool
+            # breaks, retry what is left once on a new one.
+            stale = itertools.chain(head, pending)
+            for _ in range(2):
+                pool = _get_pool()
                 try:
-                    with open(path, 'r', encoding='utf-8') as f:
-                        tree = ast.parse(f.read())
-                        count = sum(isinstance(node, ast.FunctionDef) for node in ast.walk(tree))
-                        result[path] = count
-                except Exception as e:
-                    result[path] = f'Error: {str(e)}'
+                    _collect(pool.map(count_file, stale, chunksize=_READ_BATCH))
+                    break
+                except BrokenProcessPool:
+                    _discard_pool(pool)
+                    # Finish the walk; whatever is still uncounted is in `misses`.
+                    for _ in pending:
+                        pass
+                    stale = [(path, size, mtime_ns) for path, mtime_ns, size in misses.values()]
+            else:
+                for path in list(misses):
+                    _collect([(path, 'Error: worker process terminated')])
+        if batch:
+            _report()
+    finally:
+        if token is not None:
+            ls.progress.end(token, WorkDoneProgressEnd(message=f'{done} files'))
+
+    # Files that disappeared since the last scan simply drop out here.
+    _LAST_SNAPSHOT = (folder_path, snapshot)
+    if cache_dir is not None and not _DISK_CACHE_TRIMMED:
+        _DISK_CACHE_TRIMMED = True
+        threading.Thread(target=_trim_disk_cache, args=(cache_dir,), daemon=True).start()
+    if summary_only:
+        return {'total': done}
     return result
 
 if __name__ == '__main__':
-    print(">>> Starting Function Analyzer LSP server...")
+    # stdout carries the JSON-RPC stream, so never write anything else to it.
+    if LOG_VERBOSE:
+        print(">>> Starting Function Analyzer LSP server...", file=sys.stderr)
     ls.start_io()
@@ -13,6 +13,7 @@ export interface ISettings {
     interpreter: string[];
     importStrategy: string;
     showNotifications: string;
+    excludePaths: string[];
 }
 
 export function getExtensionSettings(namespace: string, includeInterpreter?: boolean): Promise<ISettings[]> {
@@ -69,6 +70,7 @@ export async function getWorkspaceSettings(
         interpreter: resolveVariables(interpreter, workspace),
         importStrategy: config.get<string>(`importStrategy`) ?? 'useBundled',
         showNotifications: config.get<string>(`showNotifications`) ?? 'off',
+        excludePaths: config.get<string[]>(`excludePaths`) ?? [],
     };
     return workspaceSetting;
 }
@@ -97,6 +99,7 @@ export async function getGlobalSettings(namespace: string, includeInterpreter?:
         interpreter: interpreter,
         importStrategy: getGlobalValue<string>(config, 'importStrategy', 'useBundled'),
         showNotifications: getGlobalValue<string>(config, 'showNotifications', 'off'),
+        excludePaths: getGlobalValue<string[]>(config, 'excludePaths', []),
     };
     return setting;
 }
@@ -2,7 +2,7 @@ import * as vscode from 'vscode';
 import { LanguageClient, LanguageClientOptions, ServerOptions } from 'vscode-languageclient/node';
 import { registerLogger, traceError, traceLog, traceVerbose } from './common/log/logging';
 import { initializePython, onDidChangePythonInterpreter } from './common/python';
-import { checkIfConfigurationChanged } from './common/settings';
+import { checkIfConfigurationChanged, getExtensionSettings, getGlobalSettings } from './common/settings';
 import { loadServerDefaults } from './common/setup';
 import { getLSClientTraceLevel } from './common/utilities';
 import { createOutputChannel, onDidChangeConfiguration, registerCommand } from './common/vscodeapi';
@@ -15,6 +15,7 @@ export async function activate(context: vscode.ExtensionContext): Promise<void>
     const serverInfo = loadServerDefaults();
     const serverName = 'Function Analyzer';
     const serverId = 'functionAnalyzer';
+    const settingsNamespace = 'function-analyzer';
 
     const outputChannel = createOutputChannel(serverName);
     context.subscriptions.push(outputChannel, registerLogger(outputChannel));
@@ -38,6 +39,11 @@ export async function activate(context: vscode.ExtensionContext): Promise<void>
     traceVerbose(`Full Server Info: ${JSON.stringify(serverInfo)}`);
 
     const runServer = async () => {
+        if (lsClient) {
+            await lsClient.stop();
+            lsClient = undefined;
+        }
+
         // ✅ HARDCODED PYTHON INTERPRETER
         const pythonPath = context.asAbsolutePath('.venv/Scripts/python.exe');
         vscode.window.showInformationMessage('Trying to start LSP server with: ' + pythonPath);
@@ -52,6 +58,11 @@ export async function activate(context: vscode.ExtensionContext): Promise<void>
 
         const clientOptions: LanguageClientOptions = {
             documentSelector: [{ scheme: 'file', language: 'python' }],
+            initializationOptions: {
+                settings: await getExtensionSettings(settingsNamespace),
+                globalSettings: await getGlobalSettings(settingsNamespace),
+                storagePath: context.globalStorageUri.fsPath,
+            },
         };
 
         lsClient = new LanguageClient(serverId, serverName, serverOptions, clientOptions);
@@ -61,7 +72,7 @@ export async function activate(context: vscode.ExtensionContext): Promise<void>
     context.subscriptions.push(
         onDidChangePythonInterpreter(runServer),
         onDidChangeConfiguration((e: vscode.ConfigurationChangeEvent) => {
-            if (checkIfConfigurationChanged(e, serverId)) {
+            if (checkIfConfigurationChanged(e, settingsNamespace)) {
                 runServer();
             }
         }),
@@ -75,43 +86,38 @@ export async function activate(context: vscode.ExtensionContext): Promise<void>
             }
 
             const folderPath = workspaceFolders[0].uri.fsPath;
+            // Read per call, so changing excludePaths needs no server restart.
+            const config = vscode.workspace.getConfiguration(settingsNamespace, workspaceFolders[0].uri);
+            const excludePaths = config.get<string[]>('excludePaths') ?? [];
 
             if (!lsClient) {
                 vscode.window.showErrorMessage('Language Server is not running.');
                 return;
             }
 
-            await vscode.window.withProgress(
-                {
-                    location: vscode.ProgressLocation.Notification,
-                    title: 'Counting Python functions via LSP...',
-                    cancellable: false,
-                },
-                async () => {
-                    try {
-                        const result = (await lsClient!.sendRequest(EXECUTE_COMMAND, {
-                            command: 'functionAnalyzer.countFunctions',
-                            arguments: [folderPath],
-                        })) as Record<string, number> | undefined;
-
-                        if (!result) {
-                            vscode.window.showErrorMessage('Failed to retrieve function count results.');
-                            return;
-                        }
-
-                        const panel = vscode.window.createWebviewPanel(
-                            'functionAnalyzerResults',
-                            'Function Count Results',
-                            vscode.ViewColumn.One,
-                            {},
-                        );
-
-                        panel.webview.html = getWebviewContent(result);
-                    } catch (e: any) {
-                        vscode.window.showErrorMessage(`LSP command failed: ${e.message}`);
-                    }
-                },
-            );
+            // The server reports its own work done progress with a running file count.
+            try {
+                const result = (await lsClient.sendRequest(EXECUTE_COMMAND, {
+                    command: 'functionAnalyzer.countFunctions',
+                    arguments: [folderPath, { excludePaths }],
+                })) as Record<string, number> | undefined;
+
+                if (!result) {
+                    vscode.window.showErrorMessage('Failed to retrieve function count results.');
+                    return;
+                }
+
+                const panel = vscode.window.createWebviewPanel(
+                    'functionAnalyzerResults',
+                    'Function Count Results',
+                    vscode.ViewColumn.One,
+                    {},
+                );
+
+                panel.webview.html = getWebviewContent(result);
+            } catch (e: any) {
+                vscode.window.showErrorMessage(`LSP command failed: ${e.message}`);
+            }
         }),
     );
 
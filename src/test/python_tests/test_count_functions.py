@@ -0,0 +1,352 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+"""
+Test the countFunctions command handler.
+"""
+
+import collections
+import hashlib
+import os
+import sys
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+
+import pytest
+from hamcrest import assert_that, contains_exactly, has_length, is_, starts_with
+
+from .lsp_test_client import constants
+
+sys.path.insert(0, str(constants.PROJECT_ROOT / "python" / "tools"))
+import lsp_server  # noqa: E402
+
+
+class _Progress:
+    def __init__(self):
+        self.calls = []
+
+    def create(self, token):
+        self.calls.append(("create", token, None))
+
+    def begin(self, token, value):
+        self.calls.append(("begin", token, value))
+
+    def report(self, token, value):
+        self.calls.append(("report", token, value))
+
+    def end(self, token, value):
+        self.calls.append(("end", token, value))
+
+
+class _StubServer:
+    """Just enough of pygls' LanguageServer for the handler."""
+
+    def __init__(self, work_done_progress=False):
+        window = SimpleNamespace(work_done_progress=work_done_progress)
+        self.client_capabilities = SimpleNamespace(window=window)
+        self.progress = _Progress()
+        self.messages = []
+
+    def show_message(self, message, msg_type=None):
+        self.messages.append(message)
+
+
+class _FakePool:
+    """Runs map() in this process, or fails like a pool with a dead worker."""
+
+    def __init__(self, broken=False):
+        self.broken = broken
+        self.mapped = []
+        self.closed = False
+
+    def map(self, fn, items, chunksize=1):
+        items = list(items)
+        self.mapped.append(items)
+        if self.broken:
+            raise BrokenProcessPool("A child process terminated abruptly")
+        return map(fn, items)
+
+    def shutdown(self, **kwargs):
+        self.closed = True
+
+
+@pytest.fixture(name="server")
+def _server(tmp_path, monkeypatch):
+    """Fresh module state, a private disk cache and in-process fake pools."""
+    monkeypatch.setattr(lsp_server, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(lsp_server, "_DISK_CACHE_TRIMMED", True)
+    monkeypatch.setattr(lsp_server, "_PARSE_CACHE", collections.OrderedDict())
+    monkeypatch.setattr(lsp_server, "_LAST_SNAPSHOT", (None, {}))
+    monkeypatch.setattr(lsp_server, "GLOBAL_SETTINGS", {})
+    monkeypatch.setattr(lsp_server, "WORKSPACE_SETTINGS", [])
+
+    state = SimpleNamespace(scripted=[], pools=[], parsed=[], counted=[])
+
+    def _get_pool():
+        pool = state.scripted.pop(0) if state.scripted else _FakePool()
+        state.pools.append(pool)
+        return pool
+
+    count_source = lsp_server._count_source
+    count_file = lsp_server._count_file
+
+    def _count_source(source):
+        state.parsed.append(source)
+        return count_source(source)
+
+    def _count_file(item, cache_dir=None):
+        state.counted.append(item[0])
+        return count_file(item, cache_dir)
+
+    monkeypatch.setattr(lsp_server, "_get_pool", _get_pool)
+    monkeypatch.setattr(lsp_server, "_count_source", _count_source)
+    monkeypatch.setattr(lsp_server, "_count_file", _count_file)
+    return state
+
+
+def _write(root, relpath, text="def f():\n    pass\n"):
+    path = root / relpath
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding="utf8")
+    return str(path)
+
+
+def _restart(monkeypatch):
+    """Forget everything held in memory, as a server restart would."""
+    monkeypatch.setattr(lsp_server, "_PARSE_CACHE", collections.OrderedDict())
+    monkeypatch.setattr(lsp_server, "_LAST_SNAPSHOT", (None, {}))
+
+
+def _scan(folder, *args, ls=None):
+    return lsp_server.count_functions(ls or _StubServer(), [str(folder), *args])
+
+
+def test_counts_top_level_functions(tmp_path, server):
+    """Test that only module-level def and async def are counted."""
+    source = (
+        "def a():\n"
+        "    def inner():\n"
+        "        pass\n"
+        "async def b():\n"
+        "    pass\n"
+        "class C:\n"
+        "    def method(self):\n"
+        "        pass\n"
+        '"""\n'
+        "def in_a_docstring():\n"
+        '"""\n'
+    )
+    funcs = _write(tmp_path, "funcs.py", source)
+    empty = _write(tmp_path, "empty.py", "x = 1\n")
+    bad = _write(tmp_path, "bad.py", "def f(:\n")
+    _write(tmp_path, "notes.txt", "def f(): pass\n")
+
+    result = _scan(tmp_path / ".")
+
+    assert_that(sorted(result), is_(sorted([funcs, empty, bad])))
+    assert_that(result[funcs], is_(2))
+    assert_that(result[empty], is_(0))
+    assert_that(result[bad], starts_with("Error:"))
+
+
+def test_no_folder(server):
+    """Test that a missing folder argument is reported, not raised."""
+    ls = _StubServer()
+    assert_that(lsp_server.count_functions(ls, []), is_({}))
+    assert_that(ls.messages, has_length(1))
+
+
+def test_missing_folder_is_not_created(tmp_path, server):
+    """Test that scanning a path that does not exist creates nothing."""
+    missing = tmp_path / "typo" / "deeper"
+    assert_that(_scan(missing), is_({}))
+    assert_that(os.path.exists(tmp_path / "typo"), is_(False))
+
+
+def test_prunes_hidden_builtin_and_excluded_dirs(tmp_path, server):
+    """Test that hidden, built-in and excludePaths directories are skipped."""
+    kept = [_write(tmp_path, "top.py"), _write(tmp_path, "pkg/mod.py")]
+    for relpath in (".git/hook.py", "__pycache__/x.py", "venv/lib/x.py", "pkg/gen/x.py"):
+        _write(tmp_path, relpath)
+
+    result = _scan(tmp_path, {"excludePaths": ["gen"]})
+
+    assert_that(sorted(result), is_(sorted(kept)))
+
+
+def test_exclude_paths_from_innermost_workspace_folder(tmp_path, server, monkeypatch):
+    """Test that excludePaths comes from the innermost workspace folder."""
+    inner = tmp_path / "inner"
+    lsp_server.WORKSPACE_SETTINGS[:] = [
+        {"cwd": str(tmp_path), "excludePaths": ["a"]},
+        {"cwd": str(inner), "excludePaths": ["b"]},
+        {"cwd": str(tmp_path / "in"), "excludePaths": ["c"]},
+    ]
+    monkeypatch.setattr(lsp_server, "GLOBAL_SETTINGS", {"excludePaths": ["d"]})
+
+    assert_that(lsp_server._settings_for(str(inner / "pkg"))["excludePaths"], is_(["b"]))
+    assert_that(lsp_server._settings_for(str(tmp_path / "other"))["excludePaths"], is_(["a"]))
+    assert_that(lsp_server._settings_for(str(tmp_path.parent))["excludePaths"], is_(["d"]))
+
+    a = _write(inner, "a/x.py")
+    _write(inner, "b/x.py")
+    assert_that(list(_scan(inner)), is_([a]))
+    # A value sent with the command wins over the settings.
+    assert_that(_scan(inner, {"excludePaths": []}), has_length(2))
+
+
+def test_rescan_reuses_snapshot_and_drops_deleted_files(tmp_path, server):
+    """Test that a rescan only parses changed files and forgets deleted ones."""
+    keep = _write(tmp_path, "keep.py", "def keep():\n    pass\n")
+    gone = _write(tmp_path, "gone.py", "def gone():\n    pass\n")
+    edit = _write(tmp_path, "edit.py", "def edit():\n    pass\n")
+    _scan(tmp_path)
+    assert_that(server.parsed, has_length(3))
+
+    os.remove(gone)
+    _write(tmp_path, "edit.py", "def f():\n    pass\ndef g():\n    pass\n")
+    del server.parsed[:]
+    result = _scan(tmp_path)
+
+    assert_that(result, is_({keep: 1, edit: 2}))
+    assert_that(server.parsed, has_length(1))
+
+
+def test_lru_serves_counts_after_switching_folders(tmp_path, server, monkeypatch):
+    """Test that counts of an earlier folder come back from the LRU."""
+    no_disk = tmp_path / "not-a-dir"
+    no_disk.write_text("")
+    monkeypatch.setattr(lsp_server, "CACHE_DIR", str(no_disk))
+    one = _write(tmp_path, "one/x.py")
+    _write(tmp_path, "two/y.py")
+
+    _scan(tmp_path / "one")
+    _scan(tmp_path / "two")
+    del server.counted[:]
+
+    assert_that(_scan(tmp_path / "one"), is_({one: 1}))
+    assert_that(server.counted, is_([]))
+
+
+def test_disk_cache_survives_restart(tmp_path, server, monkeypatch):
+    """Test that a warm restart settles files without reading them."""
+    path = _write(tmp_path, "src/x.py")
+    _scan(tmp_path / "src")
+    _restart(monkeypatch)
+    del server.counted[:]
+
+    assert_that(_scan(tmp_path / "src"), is_({path: 1}))
+    assert_that(server.counted, is_([]))
+
+
+def test_mtime_only_change_hits_content_cache(tmp_path, server, monkeypatch):
+    """Test that a touched but unchanged file is read but not parsed again."""
+    path = _write(tmp_path, "src/x.py")
+    _scan(tmp_path / "src")
+    _restart(monkeypatch)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    del server.parsed[:]
+
+    assert_that(_scan(tmp_path / "src"), is_({path: 1}))
+    assert_that(server.counted, contains_exactly(path, path))
+    assert_that(server.parsed, is_([]))
+
+
+def _disk_entries(path):
+    cache_dir = lsp_server.CACHE_DIR
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return lsp_server._path_entry(cache_dir, path), lsp_server._cache_entry(cache_dir, digest)
+
+
+@pytest.mark.parametrize("corrupt", ["truncate", "other_python"])
+def test_bad_disk_entries_are_misses(tmp_path, server, monkeypatch, corrupt):
+    """Test that truncated or foreign disk entries are recounted and rewritten."""
+    path = _write(tmp_path, "src/x.py")
+    _scan(tmp_path / "src")
+    entries = _disk_entries(path)
+    for entry in entries:
+        with open(entry, "rb") as f:
+            data = f.read()
+        if corrupt == "truncate":
+            data = data[:-1]
+        else:
+            data = b"\x02\x07" + data[2:]
+        with open(entry, "wb") as f:
+            f.write(data)
+    _restart(monkeypatch)
+    del server.parsed[:]
+
+    assert_that(_scan(tmp_path / "src"), is_({path: 1}))
+    assert_that(server.parsed, has_length(1))
+    for entry in entries:
+        with open(entry, "rb") as f:
+            data = f.read()
+        assert_that(data, has_length(lsp_server._ENTRY.size))
+        assert_that(data[:2], is_(lsp_server._COUNTER_TAG))
+
+
+def test_partial_results_are_batched(tmp_path, server, monkeypatch):
+    """Test that a partial result token gets batches and a summary reply."""
+    monkeypatch.setattr(lsp_server, "_PARTIAL_BATCH", 2)
+    expected = {_write(tmp_path, f"m{i}.py"): 1 for i in range(5)}
+    ls = _StubServer()
+
+    result = _scan(tmp_path, {"partialResultToken": "partial"}, ls=ls)
+
+    batches = [value for kind, token, value in ls.progress.calls if token == "partial"]
+    assert_that(result, is_({"total": 5}))
+    assert_that([len(b) for b in batches], is_([2, 2, 1]))
+    assert_that({k: v for b in batches for k, v in b.items()}, is_(expected))
+
+
+def test_work_done_progress(tmp_path, server):
+    """Test that clients with work done progress see begin and end."""
+    for i in range(3):
+        _write(tmp_path, f"m{i}.py")
+    ls = _StubServer(work_done_progress=True)
+
+    _scan(tmp_path, ls=ls)
+
+    kinds = [kind for kind, _, _ in ls.progress.calls]
+    assert_that(kinds, is_(["create", "begin", "end"]))
+    assert_that(ls.progress.calls[-1][2].message, is_("3 files"))
+
+
+def test_small_scans_stay_in_process(tmp_path, server, monkeypatch):
+    """Test that only scans with enough stale files use the pool."""
+    monkeypatch.setattr(lsp_server, "_IN_PROCESS_MAX", 3)
+    small = [_write(tmp_path, f"small/m{i}.py") for i in range(2)]
+    large = [_write(tmp_path, f"large/m{i}.py") for i in range(5)]
+
+    assert_that(sorted(_scan(tmp_path / "small")), is_(small))
+    assert_that(server.pools, is_([]))
+
+    assert_that(sorted(_scan(tmp_path / "large")), is_(large))
+    assert_that(server.pools, has_length(1))
+    assert_that(sorted(p for p, _, _ in server.pools[0].mapped[0]), is_(large))
+
+
+def test_broken_pool_is_replaced_and_retried(tmp_path, server, monkeypatch):
+    """Test that a dead worker costs one retry on a new pool, not the scan."""
+    monkeypatch.setattr(lsp_server, "_IN_PROCESS_MAX", 2)
+    expected = {_write(tmp_path, f"m{i}.py"): 1 for i in range(5)}
+    server.scripted.append(_FakePool(broken=True))
+
+    assert_that(_scan(tmp_path), is_(expected))
+    broken, fresh = server.pools
+    assert_that(broken.closed, is_(True))
+    assert_that(sorted(p for p, _, _ in fresh.mapped[0]), is_(sorted(expected)))
+
+
+def test_pool_that_keeps_breaking_reports_errors(tmp_path, server, monkeypatch):
+    """Test that a second broken pool turns the remaining files into errors."""
+    monkeypatch.setattr(lsp_server, "_IN_PROCESS_MAX", 2)
+    paths = [_write(tmp_path, f"m{i}.py") for i in range(5)]
+    server.scripted.extend([_FakePool(broken=True), _FakePool(broken=True)])
+
+    result = _scan(tmp_path)
+
+    assert_that(sorted(result), is_(sorted(paths)))
+    for count in result.values():
+        assert_that(count, starts_with("Error:"))